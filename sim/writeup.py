@@ -1,9 +1,14 @@
 # %%
+from functools import lru_cache
 import numpy as np
+import numexpr as ne
 import scipy.signal as signal
 import matplotlib.pyplot as plt
 import audio_dspy as adsp
 from scipy.special import spence
+from scipy.fft import rfft, rfftfreq, next_fast_len
+from numba import njit
+from numba.extending import is_jitted
 from IPython.core.display import SVG, Image, display
 
 # %% [markdown]
@@ -47,7 +52,11 @@ from IPython.core.display import SVG, Image, display
 # with a waveshaping curve that looks as follows:
 
 # %%
-adsp.plot_static_curve(adsp.hard_clipper, gain=5)
+@njit(fastmath=True, cache=True)
+def hardClip(x):
+    return np.minimum(np.maximum(x, -1), 1) # integer bounds keep float32 input in float32
+
+adsp.plot_static_curve(hardClip, gain=5)
 plt.grid()
 plt.title('Hard Clipper Response')
 
@@ -57,23 +66,49 @@ plt.title('Hard Clipper Response')
 # frequency response:
 
 # %%
-def plot_fft(x, fs, sm=1.0/24.0):
-    fft = 20 * np.log10(np.abs(np.fft.rfft(x) + 1.0e-9))
-    freqs = np.fft.rfftfreq(len(x), 1.0 / fs)
-    return freqs, fft
-
-def process_nonlin(fc, FS, nonlin, gain=10):
+@lru_cache(maxsize=None)
+def fft_setup(N, fs):
+    n_fft = next_fast_len(N, real=True)
+    freqs = rfftfreq(n_fft, 1.0 / fs)
+    freqs.flags.writeable = False # shared by every spectrum of this size
+    return n_fft, freqs
+
+def compute_spectrum(x, fs):
+    n_fft, freqs = fft_setup(x.shape[-1], fs)
+    mag = np.abs(rfft(x, n=n_fft, workers=-1)) # one row per signal for 2-D x
+    return freqs, mag
+
+def to_db(mag):
+    return 20 * np.log10(mag + 1.0e-9)
+
+@lru_cache(maxsize=None)
+def sine(fc, fs, N):
+    phase = np.arange(N, dtype=np.float64) # float32 phase is too coarse at large n
+    phase *= 2 * np.pi * fc / fs
+    x = np.sin(phase, out=np.empty(N, dtype=np.float32))
+    x.flags.writeable = False # shared by every nonlinearity at this fc/fs
+    return x
+
+def process_nonlins(fc, FS, nonlins, gain=10, db=True):
     N = 200000
-    sin = np.sin(2 * np.pi * fc / FS * np.arange(N))
-    y = nonlin(gain * sin)
-    freqs, fft = plot_fft(y, FS)
-    return freqs, fft
+    x = gain * sine(fc, FS, N)
+    y = np.stack([nonlin(x) for nonlin in nonlins])
+    freqs, ffts = compute_spectrum(y, FS) # all rows in one batched rFFT
+    if db:
+        ffts = to_db(ffts)
+    return freqs, ffts
+
+def process_nonlin(fc, FS, nonlin, gain=10, db=True):
+    freqs, ffts = process_nonlins(fc, FS, (nonlin,), gain, db)
+    return freqs, ffts[0]
 
 FC = 1244.5
 FS = 1920000
 
-freqs_analog, fft_analog = process_nonlin(FC, FS, adsp.hard_clipper)
-peak_idxs = signal.find_peaks(fft_analog, 65)[0]
+freqs_analog, mag_analog = process_nonlin(FC, FS, hardClip, db=False)
+n_plot = np.searchsorted(freqs_analog, 25000) # only search near the plotted range
+peak_idxs = signal.find_peaks(mag_analog[:n_plot], 10**(65 / 20))[0] # 65 dB
+fft_analog = to_db(mag_analog)
 plt.plot(freqs_analog, fft_analog)
 plt.scatter(freqs_analog[peak_idxs], fft_analog[peak_idxs], c='r', marker='x')
 plt.xlim(0, 20000)
@@ -98,7 +133,7 @@ plt.grid()
 FC = 1244.5
 FS = 48000
 
-freqs_alias, fft_alias = process_nonlin(FC, FS, adsp.hard_clipper)
+freqs_alias, fft_alias = process_nonlin(FC, FS, hardClip)
 plt.plot(freqs_alias, fft_alias)
 plt.scatter(freqs_analog[peak_idxs], fft_analog[peak_idxs], c='r', marker='x')
 plt.xlim(0, 20000)
@@ -127,7 +162,7 @@ plt.grid()
 # works for out hard-clipping distortion:
 
 # %%
-freqs, fft = process_nonlin(FC, FS*4, adsp.hard_clipper)
+freqs, fft = process_nonlin(FC, FS*4, hardClip)
 plt.plot(freqs, fft)
 plt.scatter(freqs_analog[peak_idxs], fft_analog[peak_idxs], c='r', marker='x')
 plt.xlim(0, 20000)
@@ -203,31 +238,55 @@ plt.grid()
 #
 # Let's see how the aliasing artifacts look using first-order ADAA:
 # %%
+# All of the ADAA code below computes in double precision and stores the
+# result in the input's dtype: in float32, (F1(x0) - F1(x1)) / (x0 - x1)
+# cancels catastrophically when the step is close to TOL.
+@lru_cache(maxsize=None) # one compiled kernel per (f, F1), shared by instances
+def make_adaa1_kernel(f, F1):
+    # f and F1 are compile-time constants here, so Numba inlines them
+    @njit(fastmath=True)
+    def kernel(x, TOL):
+        y = np.empty_like(x)
+        x1 = 0.0
+        for n in range(x.shape[0]):
+            x0 = float(x[n])
+            if np.abs(x0 - x1) < TOL: # fallback
+                y[n] = f((x0 + x1) / 2)
+            else:
+                y[n] = (F1(x0) - F1(x1)) / (x0 - x1)
+            x1 = x0
+        return y
+    return kernel
+
 class ADAA_1:
     def __init__(self, f, F1, TOL=1.0e-5):
         self.TOL = TOL
         self.f = f
         self.F1 = F1
+        # specialized compiled loop, if the nonlinearity is written with Numba
+        self.kernel = make_adaa1_kernel(f, F1) if is_jitted(f) and is_jitted(F1) else None
 
     def process(self, x):
-        y = np.copy(x)
-        x1 = 0.0
-        for n, _ in enumerate(x):
-            if np.abs(x[n] - x1) < self.TOL: # fallback
-                y[n] = self.f((x[n] + x1) / 2)
-            else:
-                y[n] = (self.F1(x[n]) - self.F1(x1)) / (x[n] - x1)
-            x1 = x[n]
-        return y
-
-def signum(x):
-    return int(0 < x) - int(x < 0)
-
-def hardClip(x):
-    return x if np.abs(x) < 1 else signum(x)
-
+        if self.kernel is not None:
+            return self.kernel(x, self.TOL)
+
+        x0 = x.astype(np.float64)
+        x1 = np.concatenate(([0.0], x0[:-1])) # x[n-1]
+        F1_x0 = self.F1(x0)
+        F1_x1 = np.concatenate(([self.F1(0.0)], F1_x0[:-1])) # F1(x[n-1]), shifted rather than re-evaluated
+        diff = x0 - x1
+        mask = np.abs(diff) >= self.TOL # False -> fallback
+        y = np.where(mask,
+                     (F1_x0 - F1_x1) / np.where(mask, diff, 1.0),
+                     self.f((x0 + x1) / 2))
+        return y.astype(x.dtype)
+
+# branchless forms of the piecewise definitions, with c = hardClip(x)
+# and d = x - c (zero for -1 <= x <= 1), so they work on scalars and arrays
+@njit(fastmath=True, cache=True)
 def hardClipAD1(x):
-    return x * x / 2.0 if np.abs(x) < 1 else x * signum(x) - 0.5
+    c = hardClip(x)
+    return 0.5 * c * c + np.abs(x - c)
 
 hardClip_ADAA = ADAA_1(hardClip, hardClipAD1, 1.0e-5)
 freqs, fft = process_nonlin(FC, FS, hardClip_ADAA.process)
@@ -286,42 +345,94 @@ plt.grid()
 # Now we can examine the response of second-order ADAA:
 
 # %%
+@lru_cache(maxsize=None)
+def make_adaa2_kernel(f, F1, F2):
+    # same as make_adaa1_kernel; F2(x[n-1]) and the previous divided
+    # difference are carried in the loop state, as in src/ADAA/ADAA2.h
+    @njit(fastmath=True)
+    def kernel(x, TOL):
+        y = np.empty_like(x)
+        x1 = 0.0
+        x2 = 0.0
+        ad2_x1 = F2(0.0)
+        d2 = F1(0.0)
+        for n in range(x.shape[0]):
+            x0 = float(x[n])
+            ad2_x0 = F2(x0)
+            if np.abs(x0 - x1) < TOL:
+                d1 = F1((x0 + x1) / 2.0)
+            else:
+                d1 = (ad2_x0 - ad2_x1) / (x0 - x1)
+
+            if np.abs(x0 - x2) < TOL: # fallback
+                x_bar = (x0 + x2) / 2.0
+                delta = x_bar - x1
+                if np.abs(delta) < TOL:
+                    y[n] = f((x_bar + x1) / 2.0)
+                else:
+                    y[n] = (2.0 / delta) * (F1(x_bar) + (ad2_x1 - F2(x_bar)) / delta)
+            else:
+                y[n] = (2.0 / (x0 - x2)) * (d1 - d2)
+
+            d2 = d1
+            ad2_x1 = ad2_x0
+            x2 = x1
+            x1 = x0
+        return y
+    return kernel
+
 class ADAA_2:
     def __init__(self, f, F1, F2, TOL=1.0e-5):
         self.TOL = TOL
         self.f = f
         self.F1 = F1
         self.F2 = F2
+        jitted = is_jitted(f) and is_jitted(F1) and is_jitted(F2)
+        self.kernel = make_adaa2_kernel(f, F1, F2) if jitted else None
 
     def process(self, x):
-        y = np.copy(x)
-
-        def calcD(x0, x1):
-            if np.abs(x0 - x1) < self.TOL:
-                return self.F1((x0 + x1) / 2.0)
-            return (self.F2(x0) - self.F2(x1)) / (x0 - x1)
+        if self.kernel is not None:
+            return self.kernel(x, self.TOL)
 
-        def fallback(x0, x2):
-            x_bar = (x0 + x2) / 2.0
-            delta = x_bar - x0
-
-            if delta < self.TOL:
-                return self.f((x_bar + x0) / 2.0)
-            return (2.0 / delta) * (self.F1(x_bar) + (self.F2(x0) - self.F2(x_bar)) / delta)
+        y = np.empty_like(x)
+        x = x.astype(np.float64)
+        TOL, f, F1, F2 = self.TOL, self.f, self.F1, self.F2
+        ad2 = F2(x).tolist() # F2 of every input sample in one call, so F2 must accept arrays
+        x = x.tolist() # Python floats are cheaper than NumPy scalars in the loop
 
         x1 = 0.0
         x2 = 0.0
-        for n, _ in enumerate(x):
-            if np.abs(x[n] - x1) < self.TOL: # fallback
-                y[n] = fallback(x[n], x2)
+        ad2_x1 = F2(0.0)
+        d2 = F1(0.0)
+        for n in range(len(x)):
+            x0 = x[n]
+            ad2_x0 = ad2[n]
+            if abs(x0 - x1) < TOL:
+                d1 = F1((x0 + x1) / 2.0)
+            else:
+                d1 = (ad2_x0 - ad2_x1) / (x0 - x1)
+
+            if abs(x0 - x2) < TOL: # fallback
+                x_bar = (x0 + x2) / 2.0
+                delta = x_bar - x1
+                if abs(delta) < TOL:
+                    y[n] = f((x_bar + x1) / 2.0)
+                else:
+                    y[n] = (2.0 / delta) * (F1(x_bar) + (ad2_x1 - F2(x_bar)) / delta)
             else:
-                y[n] = (2.0 / (x[n] - x2)) * (calcD(x[n], x1) - calcD(x1, x2))
+                y[n] = (2.0 / (x0 - x2)) * (d1 - d2)
+
+            d2 = d1
+            ad2_x1 = ad2_x0
             x2 = x1
-            x1 = x[n]
+            x1 = x0
         return y
 
+@njit(fastmath=True, cache=True)
 def hardClipAD2(x):
-    return x * x * x / 6.0 if np.abs(x) < 1 else ((x * x / 2.0) + (1.0 / 6.0)) * signum(x) - (x/2)
+    c = hardClip(x)
+    d = x - c
+    return c * c * c / 6.0 + 0.5 * d * (1.0 + np.abs(d))
 
 hardClip_ADAA2 = ADAA_2(hardClip, hardClipAD1, hardClipAD2, 1.0e-5)
 freqs, fft = process_nonlin(FC, FS, hardClip_ADAA2.process)
@@ -372,8 +483,10 @@ plt.title(r'$\tanh$ Response')
 FC = 1244.5
 FS = 1920000
 
-freqs_analog, fft_analog = process_nonlin(FC, FS, np.tanh)
-peak_idxs = signal.find_peaks(fft_analog, 65)[0]
+freqs_analog, mag_analog = process_nonlin(FC, FS, np.tanh, db=False)
+n_plot = np.searchsorted(freqs_analog, 25000) # only search near the plotted range
+peak_idxs = signal.find_peaks(mag_analog[:n_plot], 10**(65 / 20))[0] # 65 dB
+fft_analog = to_db(mag_analog)
 plt.plot(freqs_analog, fft_analog, label='no aliasing')
 plt.scatter(freqs_analog[peak_idxs], fft_analog[peak_idxs], c='r', marker='x')
 
@@ -411,22 +524,25 @@ plt.grid()
 # aliasing artifacts for the $\tanh$ nonlinearity:
 
 # %%
+# Both antiderivatives are written in terms of t = exp(-2|x|), which never
+# overflows: log(cosh(x)) = |x| + log(1 + t) - log(2), and reflecting the
+# dilogarithm onto t reduces F_2 to sgn(x) (Li_2(-t)/2 + x^2/2 + pi^2/24) - x log(2).
 def tanh_AD1(x):
-    return np.log(np.cosh(x))
+    return np.abs(x) + np.log1p(np.exp(-2 * np.abs(x))) - np.log(2)
 
 def tanh_AD2(x):
-    expval = np.exp(-2 * x)
-    return 0.5 * (spence(1 + expval) - x * (x + 2 * np.log(expval + 1) - 2*np.log(np.cosh(x)))) + np.pi**2 / 24
+    sp = ne.evaluate('1 + exp(-2 * abs(x))')
+    spence(sp, out=sp) # not available in numexpr, but can run in-place
+    c, ln2 = np.pi**2 / 24, np.log(2)
+    return ne.evaluate('where(x < 0, -1.0, 1.0) * (0.5 * (sp + x * x) + c) - x * ln2')
 
 plt.plot(freqs_alias, fft_alias, '--', c='orange', label='No ADAA')
 
 tanh_ADAA1 = ADAA_1(np.tanh, tanh_AD1)
-freqs, fft = process_nonlin(FC, FS, tanh_ADAA1.process)
-plt.plot(freqs, fft, 'green', label='ADAA1')
-
 tanh_ADAA2 = ADAA_2(np.tanh, tanh_AD1, tanh_AD2)
-freqs, fft = process_nonlin(FC, FS, tanh_ADAA2.process)
-plt.plot(freqs, fft, 'blue', label='ADAA2')
+freqs, (fft_1, fft_2) = process_nonlins(FC, FS, (tanh_ADAA1.process, tanh_ADAA2.process))
+plt.plot(freqs, fft_1, 'green', label='ADAA1')
+plt.plot(freqs, fft_2, 'blue', label='ADAA2')
 
 plt.legend()
 plt.scatter(freqs_analog[peak_idxs], fft_analog[peak_idxs], c='r', marker='x')
@@ -56,14 +56,16 @@ private:
 
     inline double fallback (double x) noexcept
     {
+        // x ~ x2, so measure from the middle sample x1
         double xBar = 0.5 * (x + x2);
-        double delta = xBar - x;
+        double delta = xBar - x1;
 
         bool illCondition = std::abs (delta) < ADAAConst::TOL;
 
+        // ad2_x1 already holds nlFunc_AD2 (x) here (see calcD1)
         return illCondition ?
-            nlFunc (0.5 * (xBar + x)) :
-            (2.0 / delta) * (nlFunc_AD1 (xBar) + (nlFunc_AD2 (x) - nlFunc_AD2 (xBar)) / delta);
+            nlFunc (0.5 * (xBar + x1)) :
+            (2.0 / delta) * (nlFunc_AD1 (xBar) + (nlFunc_AD2 (x1) - nlFunc_AD2 (xBar)) / delta);
     }
 
     JUCE_DECLARE_NON_COPYABLE_WITH_LEAK_DETECTOR (ADAA2)